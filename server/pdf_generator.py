@@ -1,21 +1,45 @@
 #!/usr/bin/env python3
 """
 泉州感染防止ネットワーク手指衛生直接観察用フォーム PDF生成スクリプト
+
+型注釈は mypyc でそのままネイティブ拡張にコンパイルできるように付けてある（任意）:
+    mypyc --ignore-missing-imports server/pdf_generator.py
+生成された拡張モジュール（.so）があれば import 時にそちらが優先され、なければ
+この .py がそのまま使われる。
 """
 
 from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import mm, pt
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.cidfonts import UnicodeCIDFont
 from reportlab.pdfgen import canvas
-from reportlab.lib import colors
-from reportlab.platypus import Table, TableStyle, Paragraph, Spacer, PageBreak, SimpleDocTemplate
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import List, Dict, Any
+from functools import lru_cache
+from typing import List, Dict, Any, DefaultDict, Optional, Sequence, Tuple
+import heapq
 import json
 import sys
 import io
 
+# orjsonがあれば高速なJSONデコードを使う（str/bytesどちらも受け付ける）
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads  # type: ignore[assignment]
+
+# 日本語CIDフォント（モジュール読み込み時に1回だけ登録する）
+FONT_NAME = "HeiseiKakuGo-W5"
+if FONT_NAME not in pdfmetrics.getRegisteredFontNames():
+    pdfmetrics.registerFont(UnicodeCIDFont(FONT_NAME))
+
+# 描画色（RGBタプル。setFillColor/setStrokeColor にそのまま渡す）
+HEADER_FILL_COLOR = (0.93, 0.84, 0.75)  # ベージュ色
+ROW_FILL_COLOR = (1.0, 0.96, 0.94)  # 薄いピンク
+TEXT_COLOR = (0, 0, 0)
+GRID_COLOR = (0.7, 0.7, 0.7)
+
 # 5つのタイミング情報
 TIMINGS = {
     1: {"name": "患者接触前", "description": "患者に接触する前"},
@@ -25,6 +49,9 @@ TIMINGS = {
     5: {"name": "患者周辺物品接触後", "description": "患者周辺物品に接触した後"},
 }
 
+# タイミング名（行描画時の参照用）
+TIMING_NAMES = {k: v["name"] for k, v in TIMINGS.items()}
+
 # アクション情報
 ACTIONS = {
     "hand_sanitizer": "手指消毒",
@@ -32,37 +59,85 @@ ACTIONS = {
     "no_action": "実施なし",
 }
 
+# 実施済みアクションの表示ラベル
+ACTION_LABELS = {k: f"☑{v}" for k, v in ACTIONS.items()}
+
+# 1ページに描画するセッション（日付）の最大数
+MAX_SESSIONS = 8
+
+# 日付変換キャッシュの単位（15分）。タイムゾーンのオフセットや夏時間の切り替えは
+# 15分単位なので、同じ区間内のタイムスタンプはローカル日付も必ず同じになる
+DATE_BUCKET_MS = 15 * 60 * 1000
+
+
+@lru_cache(maxsize=4096)
+def _ts_to_date(bucket: int) -> str:
+    """15分区間の番号をローカル日付文字列 (YYYY-MM-DD) に変換"""
+    return datetime.fromtimestamp(bucket * DATE_BUCKET_MS / 1000).strftime("%Y-%m-%d")
+
 
 class ObservationFormPDF:
     """泉州感染防止ネットワーク手指衛生直接観察用フォームPDF生成クラス"""
 
+    # セッション番号×タイミングごとの行ラベル（例: "1. 患者接触前"）
+    _ROW_LABELS = {
+        (session_num, timing): f"{session_num}. {name}"
+        for session_num in range(1, MAX_SESSIONS + 1)
+        for timing, name in TIMING_NAMES.items()
+    }
+    
+    # 記録がないタイミングの手指衛生欄
+    _DEFAULT_ACTION_TEXT = "☐手指消毒 ☐手洗い"
+
     def __init__(self, output_path: str):
         self.output_path = output_path
-        self.page_width, self.page_height = A4
-        self.margin = 10 * mm
+        self.page_width: float = A4[0]
+        self.page_height: float = A4[1]
+        self.margin: float = 10 * mm
 
-    def generate(self, facility_info: Dict[str, str], records: List[Dict[str, Any]]) -> str:
+    def generate(self, facility_info: Dict[str, str], records: List[Dict[str, Any]],
+                 skip_empty_rows: bool = False) -> str:
         """
         PDFを生成して保存
         
         Args:
             facility_info: 施設情報（施設名、部局、病棟、科、観察者など）
             records: 記録データのリスト
+            skip_empty_rows: 記録のないタイミング行を罫線のみで描画する
             
         Returns:
             生成されたPDFファイルのパス
         """
-        c = canvas.Canvas(self.output_path, pagesize=A4)
+        data = self.render(facility_info, records, skip_empty_rows)
+        with open(self.output_path, "wb") as f:
+            f.write(data)
+        return self.output_path
+
+    def render(self, facility_info: Dict[str, str], records: List[Dict[str, Any]],
+               skip_empty_rows: bool = False) -> bytes:
+        """
+        PDFをメモリ上で生成してバイト列を返す（ファイルに保存しない呼び出し元向け）
+        
+        Args:
+            facility_info: 施設情報（施設名、部局、病棟、科、観察者など）
+            records: 記録データのリスト
+            skip_empty_rows: 記録のないタイミング行を罫線のみで描画する
+            
+        Returns:
+            生成されたPDFのバイト列
+        """
+        buf = io.BytesIO()
+        c = canvas.Canvas(buf, pagesize=A4)
         
         # ページ設定
-        c.setFont("HeiseiKakuGo-W5", 16)
+        c.setFont(FONT_NAME, 16)
         
         # タイトル
         title = "泉州感染防止ネットワーク手指衛生直接観察用フォーム"
         c.drawCentredString(self.page_width / 2, self.page_height - 20 * mm, title)
         
         # 小タイトル
-        c.setFont("HeiseiKakuGo-W5", 10)
+        c.setFont(FONT_NAME, 10)
         c.drawCentredString(self.page_width / 2, self.page_height - 28 * mm, "観察フォーム")
         
         # ヘッダー情報を描画
@@ -70,19 +145,17 @@ class ObservationFormPDF:
         y_position = self._draw_header_info(c, facility_info, y_position)
         
         # 観察テーブルを描画
-        y_position = self._draw_observation_table(c, records, y_position)
+        y_position = self._draw_observation_table(c, records, y_position, skip_empty_rows)
         
         # フッター
-        c.setFont("HeiseiKakuGo-W5", 8)
+        c.setFont(FONT_NAME, 8)
         c.drawRightString(self.page_width - 10 * mm, 10 * mm, "WHO観察フォーム一部変換")
         
         c.save()
-        return self.output_path
+        return buf.getvalue()
 
     def _draw_header_info(self, c: canvas.Canvas, facility_info: Dict[str, str], y_start: float) -> float:
         """ヘッダー情報を描画"""
-        c.setFont("HeiseiKakuGo-W5", 9)
-        
         # ヘッダーフィールド
         fields = [
             ("施設名:", facility_info.get("facilityName", "")),
@@ -98,108 +171,155 @@ class ObservationFormPDF:
         ]
         
         # 2列レイアウト
-        line_height = 5 * mm
+        line_height: float = 5 * mm
         x_left = self.margin
-        x_right = self.page_width / 2 + 5 * mm
+        x_right: float = self.page_width / 2 + 5 * mm
         
+        # ラベル・値は1つのテキストオブジェクト、下線は1つのパスにまとめて描画
+        text_draws: List[Tuple[float, float, str]] = []
+        underlines = c.beginPath()
         for i, (label, value) in enumerate(fields):
-            if i % 2 == 0:
-                x = x_left
-                y = y_start - (i // 2) * line_height
-            else:
-                x = x_right
-                y = y_start - ((i - 1) // 2) * line_height
+            x = x_left if i % 2 == 0 else x_right
+            y = y_start - (i // 2) * line_height
             
             # ラベル
-            c.drawString(x, y, label)
+            text_draws.append((x, y, label))
             
             # 値（下線付き）
-            c.line(x + 25 * mm, y - 1 * mm, x + 60 * mm, y - 1 * mm)
+            underlines.moveTo(x + 25 * mm, y - 1 * mm)
+            underlines.lineTo(x + 60 * mm, y - 1 * mm)
             if value:
-                c.drawString(x + 26 * mm, y - 2 * mm, str(value))
+                text_draws.append((x + 26 * mm, y - 2 * mm, str(value)))
+        
+        c.drawPath(underlines, stroke=1, fill=0)
+        self._draw_strings(c, 9, text_draws)
         
         return y_start - 6 * line_height
 
-    def _draw_observation_table(self, c: canvas.Canvas, records: List[Dict[str, Any]], y_start: float) -> float:
+    def _draw_observation_table(self, c: canvas.Canvas, records: List[Dict[str, Any]], y_start: float,
+                                skip_empty_rows: bool = False) -> float:
         """観察テーブルを描画"""
-        c.setFont("HeiseiKakuGo-W5", 8)
-        
         # テーブルの開始位置
-        y = y_start - 10 * mm
+        y: float = y_start - 10 * mm
         table_width = self.page_width - 2 * self.margin
         col_width = table_width / 4
-        row_height = 8 * mm
+        row_height: float = 8 * mm
         
-        # ヘッダー行
-        c.setFillColorRGB(0.93, 0.84, 0.75)  # ベージュ色
-        c.rect(self.margin, y - row_height, table_width, row_height, fill=1)
+        # 各列の文字位置と行内の文字の高さ（ループ内で再計算しない）
+        margin = self.margin
+        x0: float = margin + 2 * mm
+        x1 = x0 + col_width
+        x2 = x1 + col_width
+        text_dy: float = 2 * mm - row_height
+        
+        # 描画内容を先に集め、塗り・文字・罫線ごとにまとめて描画する
+        fill_rects: List[Tuple[float, float, float, float]] = []
+        stroke_rects: List[Tuple[float, float, float, float]] = []
+        text_draws: List[Tuple[float, float, str]] = []
         
-        # ヘッダーテキスト
-        c.setFont("HeiseiKakuGo-W5", 7)
+        # ヘッダー行
+        header_rect = (margin, y - row_height, table_width, row_height)
+        stroke_rects.append(header_rect)
         headers = ["機会", "適応", "手指衛生", "機会"]
         for i, header in enumerate(headers):
-            x = self.margin + i * col_width + 2 * mm
-            c.drawString(x, y - row_height + 2 * mm, header)
+            text_draws.append((x0 + i * col_width, y + text_dy, header))
         
         y -= row_height
         
-        # 記録データを日付別にグループ化
-        records_by_date = {}
+        # 記録データを日付・タイミング別にグループ化（1パス）
+        buckets: DefaultDict[str, DefaultDict[Any, List[Dict[str, Any]]]] = defaultdict(lambda: defaultdict(list))
         for record in records:
-            date_key = datetime.fromtimestamp(record.get("timestamp", 0) / 1000).strftime("%Y-%m-%d")
-            if date_key not in records_by_date:
-                records_by_date[date_key] = []
-            records_by_date[date_key].append(record)
+            date_key = _ts_to_date(int(record.get("timestamp", 0)) // DATE_BUCKET_MS)
+            buckets[date_key][record.get("timing")].append(record)
         
         # セッション番号（最大8）
-        session_num = 0
-        for date_key in sorted(records_by_date.keys())[:8]:
-            session_records = records_by_date[date_key]
-            session_num += 1
+        row_labels = self._ROW_LABELS
+        default_action_text = self._DEFAULT_ACTION_TEXT
+        for session_num, date_key in enumerate(heapq.nsmallest(MAX_SESSIONS, buckets), 1):
+            session_buckets = buckets[date_key]
             
             # 5つのタイミングの行を描画
-            for timing in range(1, 6):
-                timing_records = [r for r in session_records if r.get("timing") == timing]
+            for timing in TIMING_NAMES:
+                timing_records: Sequence[Dict[str, Any]] = session_buckets.get(timing, ())
+                
+                # 背景と罫線
+                row_rect = (margin, y - row_height, table_width, row_height)
+                stroke_rects.append(row_rect)
+                
+                # 記録のない行は罫線のみ
+                if skip_empty_rows and not timing_records:
+                    y -= row_height
+                    continue
                 
-                # 背景色（ピンク系）
-                c.setFillColorRGB(1.0, 0.96, 0.94)  # 薄いピンク
-                c.rect(self.margin, y - row_height, table_width, row_height, fill=1)
+                fill_rects.append(row_rect)
                 
                 # セッション番号とタイミング
-                c.setFont("HeiseiKakuGo-W5", 7)
-                timing_info = TIMINGS.get(timing, {})
-                timing_text = f"{session_num}. {timing_info.get('name', '')}"
-                c.drawString(self.margin + 2 * mm, y - row_height + 2 * mm, timing_text)
+                text_y = y + text_dy
+                text_draws.append((x0, text_y, row_labels[session_num, timing]))
                 
                 # 適応状況
                 applicable = "☑" if timing_records else "☐"
-                c.drawString(self.margin + col_width + 2 * mm, y - row_height + 2 * mm, applicable)
+                text_draws.append((x1, text_y, applicable))
                 
                 # 手指衛生実施内容
-                actions = []
-                for record in timing_records:
-                    action = record.get("action", "")
-                    if action == "hand_sanitizer":
-                        actions.append("☑手指消毒")
-                    elif action == "hand_wash":
-                        actions.append("☑手洗い")
-                    elif action == "no_action":
-                        actions.append("☑実施なし")
-                
-                if not actions:
-                    actions = ["☐手指消毒", "☐手洗い", "☐実施なし"]
-                
-                action_text = " ".join(actions[:2])  # 最初の2つを表示
-                c.drawString(self.margin + 2 * col_width + 2 * mm, y - row_height + 2 * mm, action_text)
-                
-                # 罫線
-                c.setStrokeColorRGB(0.7, 0.7, 0.7)
-                c.rect(self.margin, y - row_height, table_width, row_height)
+                # 大半を占める記録0件・1件の行はリストを作らずに文字列を決める
+                record_count = len(timing_records)
+                if record_count == 0:
+                    action_text = default_action_text
+                elif record_count == 1:
+                    action_text = ACTION_LABELS.get(timing_records[0].get("action", ""), default_action_text)
+                else:
+                    actions = [label for r in timing_records if (label := ACTION_LABELS.get(r.get("action", "")))]
+                    action_text = " ".join(actions[:2]) if actions else default_action_text  # 最初の2つを表示
+                text_draws.append((x2, text_y, action_text))
                 
                 y -= row_height
         
+        # 背景色（ヘッダーはベージュ、記録行は薄いピンク）
+        c.setFillColor(HEADER_FILL_COLOR)
+        c.rect(*header_rect, fill=1, stroke=0)
+        if fill_rects:
+            fill_path = c.beginPath()
+            for rect in fill_rects:
+                fill_path.rect(*rect)
+            c.setFillColor(ROW_FILL_COLOR)
+            c.drawPath(fill_path, fill=1, stroke=0)
+        
+        # テキスト
+        c.setFillColor(TEXT_COLOR)
+        self._draw_strings(c, 7, text_draws)
+        
+        # 罫線
+        stroke_path = c.beginPath()
+        for rect in stroke_rects:
+            stroke_path.rect(*rect)
+        c.setStrokeColor(GRID_COLOR)
+        c.drawPath(stroke_path, stroke=1, fill=0)
+        
         return y
 
+    def _draw_strings(self, c: canvas.Canvas, font_size: float, text_draws: List[Tuple[float, float, str]]) -> None:
+        """
+        複数の文字列を1つのテキストオブジェクトでまとめて描画
+        
+        2つ目以降の文字列は直前の文字列からの相対移動で配置するため、
+        フォント指定とテキストブロックの開始・終了は1回だけになる。
+        """
+        if not text_draws:
+            return
+        
+        text = c.beginText()
+        text.setFont(FONT_NAME, font_size)
+        prev_x, prev_y, first = text_draws[0]
+        text.setTextOrigin(prev_x, prev_y)
+        text.textOut(first)
+        for x, y, s in text_draws[1:]:
+            # moveCursor は下方向を正とする
+            text.moveCursor(x - prev_x, prev_y - y)
+            text.textOut(s)
+            prev_x, prev_y = x, y
+        c.drawText(text)
+
     def generate_from_json(self, json_data: str) -> str:
         """
         JSON形式のデータからPDFを生成
@@ -210,17 +330,76 @@ class ObservationFormPDF:
         Returns:
             生成されたPDFファイルのパス
         """
-        data = json.loads(json_data)
-        facility_info = data.get("facilityInfo", {})
-        records = data.get("records", [])
+        return self.generate_from_dict(_loads(json_data))
+
+    def generate_from_dict(self, data: Dict[str, Any]) -> str:
+        """
+        デコード済みのデータからPDFを生成（JSONの再エンコード・再デコードを避ける）
+        
+        Args:
+            data: facilityInfo と records を含む辞書
+            
+        Returns:
+            生成されたPDFファイルのパス
+        """
+        return self.generate(data.get("facilityInfo", {}), data.get("records", []))
+
+
+def _generate_job(job: Tuple[str, Dict[str, Any]]) -> str:
+    """generate_many 用: 1ジョブ分のPDFを生成（プロセスプールから呼ばれる）"""
+    output_path, data = job
+    return ObservationFormPDF(output_path).generate_from_dict(data)
+
+
+def generate_many(jobs: List[Tuple[str, Dict[str, Any]]], max_workers: Optional[int] = None) -> List[str]:
+    """
+    複数のPDFをプロセスプールで並列に生成
+    
+    描画ループはGILを保持したまま動くため、スレッドではなくプロセスで並列化する。
+    
+    Args:
+        jobs: (出力パス, facilityInfo と records を含む辞書) のリスト
+        max_workers: ワーカープロセス数（省略時はCPU数）
         
-        return self.generate(facility_info, records)
+    Returns:
+        生成されたPDFファイルのパスのリスト（jobs と同じ順序）
+    """
+    if len(jobs) <= 1:
+        return [_generate_job(job) for job in jobs]
+    
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_generate_job, jobs))
+
+
+def _serve():
+    """
+    常駐モード: 標準入力から1行1ジョブのJSONを読み、結果を1行ずつ標準出力に返す
+    
+    ジョブ形式: {"output_path": "...", "data": {"facilityInfo": {...}, "records": [...]}}
+    reportlabの読み込みやフォントの初期化をジョブごとに繰り返さない。
+    """
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            job = _loads(line)
+            generator = ObservationFormPDF(job["output_path"])
+            result_path = generator.generate_from_dict(job.get("data", {}))
+            result = {"success": True, "path": result_path}
+        except Exception as e:
+            result = {"success": False, "error": str(e)}
+        print(json.dumps(result), flush=True)
 
 
 def main():
     """メイン関数"""
+    if len(sys.argv) == 2 and sys.argv[1] == "--serve":
+        _serve()
+        return
+    
     if len(sys.argv) < 3:
         print("Usage: python pdf_generator.py <output_path> <json_data>")
+        print("       python pdf_generator.py --serve")
         sys.exit(1)
     
     output_path = sys.argv[1]